@@ -18,13 +18,60 @@
 # import libraries
 import numpy     as np
 import pandas    as pd
-import datetime  as dt
 import geopandas as gp
+import pyarrow   as pa
+import datetime  as dt
 import warnings  as wn
 
 from tqdm        import tqdm
+from pyarrow     import csv as pa_csv
+from joblib      import Parallel, delayed
+from scipy.spatial import cKDTree
+
+# copy-on-write avoids the implicit copies of loc/assign/concat (always on with pandas >= 3)
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.options.mode.copy_on_write = True
+
+
+def _to_timestamp(dates):
+    """
+    Converts a series of dates (strings or datetime of any resolution) to timestamps in seconds
+    """
+    
+    return pd.to_datetime(dates).to_numpy().astype("datetime64[s]").astype(np.int64)
 
-wn.filterwarnings("ignore")
+
+def _process_window(uids, ts, coords, dst):
+    """
+    Seeks for the intersections between nodes within a single partition
+    
+    Parameters
+    ----------
+    uids   : user identifiers of the partition's observations
+    ts     : timestamps of the partition's observations
+    coords : projected positions (x, y in meters) of the partition's observations
+    dst    : the short range communication distance of each device (in meters)
+    """
+    
+    # rank the users by order of appearance within the partition
+    ranks = pd.factorize(uids)[0]
+
+    # two areas intersect when their centers are closer than twice the radius
+    tree  = cKDTree(coords)
+    pairs = tree.query_pairs(r=2 * dst, output_type="ndarray")
+    
+    # keep the couples of distinct users, ordered by their appearance
+    i, j  = pairs[:, 0], pairs[:, 1]
+    mask  = ranks[i] != ranks[j]
+    i, j  = i[mask], j[mask]
+    left  = np.where(ranks[i] < ranks[j], i, j)
+    right = np.where(ranks[i] < ranks[j], j, i)
+
+    # insert all the intersection information of a partition into a dataframe                    
+    return pd.DataFrame({"uid_1"           : uids[left], 
+                         "timestamp_uid_1" : ts[left], 
+                         "uid_2"           : uids[right], 
+                         "timestamp_uid_2" : ts[right]})
 
 
 # define the Colocation class with assignment
@@ -49,6 +96,8 @@ class Colocation:
     
     print_dataframe
     
+    preprocess
+    
     from_date_string_to_datetime
     
     from_datetime_to_timestamp
@@ -59,8 +108,12 @@ class Colocation:
     
     dataframe_split
     
+    iter_intersections
+    
     get_intersections
     
+    get_colocations
+    
     """
     
     def __init__(self, data):
@@ -73,37 +126,67 @@ class Colocation:
                            ["user_id", "latitude", "longitude", "sampletimestamp", "accuracy"]
         """
         
-        self.data = pd.read_csv(data, header=0).filter(["user_id", "latitude", "longitude", "sampletimestamp", "accuracy"])
+        self.data = pd.read_csv(data, header=0, engine="pyarrow", 
+                                usecols=["user_id", "latitude", "longitude", "sampletimestamp", "accuracy"], 
+                                dtype={"latitude" : "float64", "longitude" : "float64", "accuracy" : "float32"}, 
+                                parse_dates=["sampletimestamp"])
 
     def users_mapping(self):
         """
         Anonymize the n user identifiers by re-labelling the user_id from 0 to n 
+        (the original identifiers are kept in _user_labels, indexed by the new ones)
         """
         
-        users = self.data.user_id.unique()
+        codes, uniques = pd.factorize(self.data["user_id"], sort=False)
         
-        map_uid = dict(zip(users, np.arange(0, len(users))))
+        self.data["user_id"] = codes.astype(np.int32)
+        self._user_labels = uniques
         
-        self.data = self.data.replace({"user_id" : map_uid})
+    def preprocess(self, limit=50):
+        """
+        Deletes all the dataframe observations that exceed a given accuracy and
+        converts the remaining datetime to timestamp, in a single pass
+        
+        Parameter
+        ----------
+        limit : int
+            the maximum accuracy limit (default 50m) 
+            
+        """
+        
+        mask = self.data.accuracy.to_numpy() <= limit
+        
+        self.data = self.data.loc[mask].assign(sampletimestamp=_to_timestamp(self.data.sampletimestamp[mask]))
         
     def from_date_string_to_datetime(self):
         """
-        Converts all date string to datetime format
+        Converts all date string to datetime format (the dates are already
+        parsed when reading the csv file, so this is a no-op on that data)
+        
+        Deprecated: use preprocess
         """
         
+        wn.warn("from_date_string_to_datetime is deprecated, use preprocess", DeprecationWarning, stacklevel=2)
+        
         self.data.sampletimestamp = pd.to_datetime(self.data.sampletimestamp)
         
     def from_datetime_to_timestamp(self):
         """
         Converts all datetime to timestamp
+        
+        Deprecated: use preprocess
         """
         
-        self.data.sampletimestamp = self.data.sampletimestamp.values.astype(np.int64) // 10 ** 9
+        wn.warn("from_datetime_to_timestamp is deprecated, use preprocess", DeprecationWarning, stacklevel=2)
+        
+        self.data.sampletimestamp = _to_timestamp(self.data.sampletimestamp)
     
     def accuracy_threshold(self, limit=50):
         """
         Deletes all the dataframe observations that exceed a given accuracy
         
+        Deprecated: use preprocess
+        
         Parameter
         ----------
         limit : int
@@ -111,12 +194,15 @@ class Colocation:
             
         """
         
+        wn.warn("accuracy_threshold is deprecated, use preprocess", DeprecationWarning, stacklevel=2)
+        
         self.data = self.data.loc[self.data.accuracy <= limit]
         
     def add_short_range_communication_area(self, dst=100):
         """
-        Adds the short range communication area information as a
-        polygon (circle) to the dataframe  
+        Sets the short range communication area of each device as a
+        circle of radius dst around its position, projecting the positions
+        into the local UTM zone (x, y in meters)
         
         Parameter
         ---------
@@ -124,7 +210,17 @@ class Colocation:
             the distance from the center in meters (default 100m)            
         """
 
-        self.data["short_range_communication_area"] = gp.points_from_xy(self.data.latitude, self.data.longitude).buffer(dst / 100000)
+        # project each distinct position only once (stationary devices repeat their samples)
+        coords, inverse = np.unique(self.data[["longitude", "latitude"]].to_numpy(), axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        
+        points = gp.GeoSeries(gp.points_from_xy(coords[:, 0], coords[:, 1]), crs="EPSG:4326")
+        points = points.to_crs(points.estimate_utm_crs())
+        
+        self.data["x"] = points.x.to_numpy()[inverse]
+        self.data["y"] = points.y.to_numpy()[inverse]
+        
+        self.dst = dst
     
     def dataframe_split(self, tw=150):
         """
@@ -141,102 +237,106 @@ class Colocation:
         # list of dataframes
         df_split_list = []
         
+        # sort the mobility traces by time once, so that each partition is a slice
+        self.data = self.data.sort_values("sampletimestamp", kind="mergesort").reset_index(drop=True)
+        stamps = self.data.sampletimestamp.to_numpy()
+        
         # get the time limits
-        min_stp = self.data.sampletimestamp.min()
-        max_stp = self.data.sampletimestamp.max()
+        min_stp = stamps.min()
+        max_stp = stamps.max()
         
         # get the number of dataframes + 1 ()
         df_s = int((max_stp - min_stp) / tw) + 1        
         
+        # get the slice bounds of each interval (both ends included)
+        lower = min_stp + tw * np.arange(df_s)
+        start = np.searchsorted(stamps, lower, side="left")
+        end   = np.searchsorted(stamps, lower + tw, side="right")
+        
         for i in tqdm(range(df_s), desc="Splitting the dataframe:\t"):
             
-            # split the mobility traces into a partition (dataframe)
-            df_temp = self.data[(self.data.sampletimestamp >= min_stp) & (\
-                                    self.data.sampletimestamp <= min_stp + tw)]
             # append the partition (dataframe) to the list
-            df_split_list.append(df_temp)
-            # increase the minimum time limit for the following interval
-            min_stp = min_stp + tw
+            df_split_list.append(self.data.iloc[start[i]:end[i]])
         
         return df_split_list
     
-    def get_intersections(self):
+    def iter_intersections(self, n_jobs=-1):
         """
         Splits the mobility traces into several datasets and for each one seeks for intersections
-        between nodes (contact spatial information)
+        between nodes (contact spatial information), yielding one partition at a time
+        
+        Parameter
+        ---------
+        n_jobs : int
+           the number of processes working on the partitions in parallel (default -1, i.e. all the cores)
 
         """
 
-        df_dfs_int = []
-
         # split the mobility traces dataset in partitions
         df_split = self.dataframe_split()
         
+        # hand over to the workers only the columns of interest of each partition
+        tasks = (delayed(_process_window)(single_df_split["user_id"].to_numpy(), 
+                                          single_df_split["sampletimestamp"].to_numpy(), 
+                                          single_df_split[["x", "y"]].to_numpy(), 
+                                          self.dst) for single_df_split in df_split)
+        
         # seek for each partition the nodes' intersections (spatial information)
-        for single_df_split in tqdm(df_split, desc="Seeking for intersections:\t"):
-            df_dfs = {}
-            intersections = []
-            users = single_df_split.user_id.unique()
-            for user in users:
-                df_dfs[user] = single_df_split.loc[single_df_split.user_id == user].reset_index().filter(["user_id", \
-                            "latitude", "longitude", "sampletimestamp", "short_range_communication_area"])
-
-            for k in range(len(users)-1):
-                subject = users[k]
-                other_users = users[k+1:]
-                for i in df_dfs[subject].iterrows():
-                    for usr in other_users:
-                        for j in df_dfs[usr].iterrows():
-                            if(i[1].short_range_communication_area.intersects(j[1].short_range_communication_area)):
-                                intersections.append([i[1].user_id, i[1].sampletimestamp, j[1].user_id, j[1].sampletimestamp])
-
-            # insert all the intersection information of a partition into a dataframe                    
-            df_int = pd.DataFrame(intersections, columns=["uid_1", "timestamp_uid_1", "uid_2", "timestamp_uid_2"])
+        results = Parallel(n_jobs=n_jobs, prefer="processes", batch_size="auto", return_as="generator")(tasks)
+        
+        yield from tqdm(results, total=len(df_split), desc="Seeking for intersections:\t")
     
-            df_dfs_int.append(df_int)
+    def get_intersections(self, n_jobs=-1):
+        """
+        Returns the list of the intersections of all the partitions (see iter_intersections)
+
+        """
         
-        return df_dfs_int
+        return list(self.iter_intersections(n_jobs))
     
-    def get_colocations(self):
+    def get_colocations(self, n_jobs=-1):
         """
         Generates the co-location information (performing the above splitting procedure)
         
-        """
-        # empty dataframe to store all the co-locations
-        df_ac = pd.DataFrame()
+        Parameter
+        ---------
+        n_jobs : int
+           the number of processes seeking for intersections (default -1, i.e. all the cores)
         
-        # get all the intersections for all the mobility traces (splitted)
-        df_dfs_int = self.get_intersections()
+        """
+        # columns of the co-locations, collected partition by partition
+        node_1, node_2, timestamp, connection = [], [], [], []
 
-        # getting the colocations for all the dataset's partition
-        for df in tqdm(df_dfs_int, desc="Generating the co-locations\t"):
+        # getting the colocations for each partition as soon as its intersections are found
+        for df in self.iter_intersections(n_jobs):
 
+            # group the rows by users' couple
+            g = df.groupby(["uid_1", "uid_2"])
+            
+            # collect the temporal information of each couple
+            mn = np.minimum(g.timestamp_uid_1.min().to_numpy(), g.timestamp_uid_2.min().to_numpy())
+            mx = np.maximum(g.timestamp_uid_1.max().to_numpy(), g.timestamp_uid_2.max().to_numpy())
+            
             # get all the uniques users' couples
-            users_couples = [list(c) for c in set(tuple(c) \
-                                for c in [[user[1].uid_1, user[1].uid_2] for user in df.iterrows()])]
-            # get co-locations of a single partition
-            coloc = []
-            for couple in users_couples:
-                # filter to the rows of interest
-                sc = df[(df.uid_1 == couple[0]) & (df.uid_2 == couple[1])]
-                # collect the temporal information and generate the co-locations
-                df_time = pd.concat([sc.timestamp_uid_1, sc.timestamp_uid_2])
-                coloc.append([couple[0], couple[1], df_time.min(), "up"])
-                coloc.append([couple[0], couple[1], df_time.max(), "down"])
-                coloc.append([couple[1], couple[0], df_time.min(), "up"])
-                coloc.append([couple[1], couple[0], df_time.max(), "down"])
-    
-            # order the co-locations into a dataframe
-            df_coloc = pd.DataFrame(coloc, columns=["node_1", "node_2", "timestamp", "connection"])
+            couples = g.size().index
+            u1 = couples.get_level_values("uid_1").to_numpy()
+            u2 = couples.get_level_values("uid_2").to_numpy()
+            
+            # generate the co-locations of a single partition (up/down in both directions)
+            node_1.append(np.stack([u1, u1, u2, u2], axis=1).ravel())
+            node_2.append(np.stack([u2, u2, u1, u1], axis=1).ravel())
+            timestamp.append(np.stack([mn, mx, mn, mx], axis=1).ravel())
+            connection.append(np.tile(["up", "down"], 2 * len(couples)))
     
-            # concatenate the dataframe
-            df_ac = pd.concat([df_ac, df_coloc])
+        # order all the co-locations into a dataframe
+        df_ac = pd.DataFrame({"node_1"     : np.concatenate(node_1),
+                              "node_2"     : np.concatenate(node_2),
+                              "timestamp"  : np.concatenate(timestamp),
+                              "connection" : np.concatenate(connection)})
             
-        # reset the index of the co-locations
-        df_ac = df_ac.reset_index().filter(["node_1", "node_2", "timestamp", "connection"])
-        
         # save and return the co-locations
-        df_ac.to_csv("output//co_locations.csv", index=False)
+        pa_csv.write_csv(pa.Table.from_pandas(df_ac, preserve_index=False), "output//co_locations.csv", 
+                         write_options=pa_csv.WriteOptions(include_header=True, quoting_style="none", quoting_header="none"))
         
         print("Done!")
         return df_ac
@@ -248,13 +348,9 @@ if __name__ == '__main__':
     obj = Colocation("input//test_dataset.csv")
     # anonymization of the data
     obj.users_mapping()
-    # filter for accuracy (none = 50m)
-    obj.accuracy_threshold()
+    # filter for accuracy (none = 50m) and convert to timestamp
+    obj.preprocess()
     # it takes a minute for the computation (none = 100m)
     obj.add_short_range_communication_area(500)
-    # convert to datetime
-    obj.from_date_string_to_datetime()
-    # convert to timestamp
-    obj.from_datetime_to_timestamp()
     # get the co-locations and save them into a "co_locations.csv" file
     co_locations = obj.get_colocations()